@@ -1,32 +1,49 @@
+import os
+# Split the cores between the server worker processes and cap the OpenMP/MKL
+# pools before torch, numpy and xgboost are imported, so they don't
+# oversubscribe the CPU
+try:
+    GUNICORN_WORKERS = max(1, int(os.environ.get("GUNICORN_WORKERS", "1")))
+except ValueError:
+    GUNICORN_WORKERS = 1
+INFERENCE_THREADS = max(1, (os.cpu_count() or 1) // GUNICORN_WORKERS)
+os.environ.setdefault("OMP_NUM_THREADS", str(INFERENCE_THREADS))
+os.environ.setdefault("MKL_NUM_THREADS", str(INFERENCE_THREADS))
 import json
 import joblib
-from django.http import JsonResponse
+import orjson
+from django.http import HttpResponse, JsonResponse
 from django.views.decorators.csrf import csrf_exempt
 import ast
 from transformers import AutoTokenizer, AutoModel
 import torch
 import numpy as np
 import inflect
-from scipy.sparse import hstack
-from sklearn.metrics.pairwise import cosine_similarity
 from rapidfuzz import fuzz
+from rapidfuzz.process import cdist
 from openai import OpenAI
 from django.http import JsonResponse
-import os
+import functools
+import hashlib
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import re
 import base64
+import diskcache
 from dotenv import load_dotenv
-from PIL import Image
 import base64
 import json
 import psycopg2
-import pandas as pd
 import xgboost as xgb
 import cv2
-from pyzbar.pyzbar import decode
 
 
+torch.set_num_threads(INFERENCE_THREADS)
 load_dotenv()
 # Fetch variables
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
@@ -70,87 +87,79 @@ def load_model():
     print("Model loaded successfully using joblib.")
     return model
 XG = load_model()
+XG.set_params(n_jobs=INFERENCE_THREADS)
+# Predict through the raw booster to skip the sklearn wrapper's DMatrix copy
+XG_BOOSTER = XG.get_booster()
+XG_BOOSTER.set_param({"nthread": INFERENCE_THREADS})
+# Feature order the XGBoost model was trained on
+XG_COLUMNS = (
+    'sugar_level', 'cholesterol_level', 'blood_pressure', 'bmi', 'age', 'heart_rate',
+    'sugar_in_product', 'salt_in_product', 'saturated_fat_in_product', 'carbohydrates_in_product'
+)
 # Function to make predictions
 def predict(input_data):
     """
-    Load the model, make predictions, and release the model after use.
+    Make a health score prediction with the loaded XGBoost model.
     :param input_data: A dictionary containing input features.
-    :return: Model predictions.
+    :return: Model prediction clipped to the 0-100 score range.
     """
-    # Load the model
-    
-
-    # If the input is a dictionary, convert it to a DataFrame
+    # Build the single feature row directly as a NumPy array; OpenFoodFacts can
+    # return string nutrient values, so coerce them to floats
     if isinstance(input_data, dict):
-        input_data = pd.DataFrame([input_data])  # Convert dict to DataFrame for consistency
+        input_data = np.fromiter(
+            (float(input_data[column]) for column in XG_COLUMNS),
+            dtype=np.float32,
+            count=len(XG_COLUMNS),
+        ).reshape(1, -1)
 
-    # Make predictions using the DataFrame (or NumPy array)
-    predictions = XG.predict(input_data)
+    predictions = XG_BOOSTER.inplace_predict(input_data)
 
-    # Explicitly delete the model to free memory
-    integer_value = int(predictions)
-    return integer_value
+    return int(round(np.clip(predictions[0], 0, 100)))
 
 
 
+def BarcodeReader(img):
+    # Detect and decode every barcode in the full frame in one pass
+    detector = cv2.barcode.BarcodeDetector()
+    ok, decoded_info, decoded_type, _ = detector.detectAndDecodeWithType(img)
 
-def BarcodeReader(image_path):
-    # Read the image in numpy array using cv2
-    img = cv2.imread(image_path)
+    # Detected barcodes that could not be decoded come back as empty strings
+    barcode_data = [
+        {"data": data, "type": barcode_type}
+        for data, barcode_type in zip(decoded_info, decoded_type) if data
+    ] if ok else []
+    non_url_data = [item['data'] for item in barcode_data if not is_url(item['data'])]
 
-    # Decode the barcode image
-    detectedBarcodes = decode(img)
+    # The barcode detector only reads 1-D symbologies, so fall back to QR codes
+    if not non_url_data:
+        ok, decoded_info, _, _ = cv2.QRCodeDetector().detectAndDecodeMulti(img)
+        if ok:
+            non_url_data = [data for data in decoded_info if data and not is_url(data)]
 
     # If not detected, return a message
-    if not detectedBarcodes:
+    if not non_url_data:
         return "error:barcode not detected"
-    else:
-        barcode_data = []
-        # Traverse through all the detected barcodes in image
-        
-        for barcode in detectedBarcodes:
-            # Print the barcode data
-            barcode_data.append({
-                "data": barcode.data.decode("utf-8"),
-                "type": barcode.type
-            })
-        non_url_data = []
-        for item in barcode_data:
-            if 'data' in item and not is_url(item['data']):
-                non_url_data.append(item['data'])
-
-        # Output the result
-        print("Non-URL Barcode Data:", non_url_data[0])
-        #print( "Barcode Data: ", barcode_data[0].data)
-        #cv2.imshow("Barcode Detected",img)
-        #cv2.waitKey(0)
-        #cv2.destroyAllWindows() 
-        return non_url_data[0]
+
+    # Output the result
+    print("Non-URL Barcode Data:", non_url_data[0])
+    return non_url_data[0]
 def is_url(data):
-    return re.match(r'^https?://', data) is not None
+    return data.startswith(("http://", "https://"))
 client = OpenAI(api_key=OPENAI_API_KEY)
-# Directory to save decoded images
-UPLOAD_DIR = "./uploads"
-os.makedirs(UPLOAD_DIR, exist_ok=True)
-UPLOAD_DIRS = "./uploaded_images"
-os.makedirs(UPLOAD_DIRS, exist_ok=True)
-def crop_image(file_path):
-    """Crops the image into a square centered on the image."""
-    with Image.open(file_path) as img:
-        width, height = img.size
-        box_size = min(width, height)
-
-        # Calculate coordinates for the square crop
-        left = (width - box_size) / 2
-        top = (height - box_size) / 2
-        right = left + box_size
-        bottom = top + box_size
-
-        cropped_img = img.crop((left, top, right, bottom))
-        cropped_file_path = os.path.join(UPLOAD_DIR, "cropped_image.jpg")
-        cropped_img.save(cropped_file_path)
-
-    return cropped_file_path
+# Thread pool for the network calls a request can overlap
+io_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="io")
+# Persistent cache for OpenFoodFacts and OpenAI responses
+CACHE_DIR = "./cache"
+CACHE_EXPIRE = 86400
+response_cache = diskcache.Cache(CACHE_DIR)
+# Shared session so OpenFoodFacts calls reuse pooled connections
+OFF_TIMEOUT = (2, 5)
+http_session = requests.Session()
+http_session.mount("https://", HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=32,
+    max_retries=Retry(total=2, backoff_factor=0.2)
+))
 @csrf_exempt
 def upload_base64(request):
     try:
@@ -170,18 +179,13 @@ def upload_base64(request):
         except base64.binascii.Error:
             return JsonResponse({"error": "Invalid Base64 data"}, status=400)
 
-        # Save the decoded image
-        if not os.path.exists(UPLOAD_DIRS):
-            os.makedirs(UPLOAD_DIRS)
-        file_path = os.path.join(UPLOAD_DIRS, "uploaded_image.jpg")
-        with open(file_path, "wb") as image_file:
-            image_file.write(image_bytes)
+        # Decode the image in memory
+        img = cv2.imdecode(np.frombuffer(image_bytes, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if img is None:
+            return JsonResponse({"error": "Invalid image data"}, status=400)
 
-        # Crop the image
-        cropped_file_path = crop_image(file_path)
-
-        # Read the barcode from the cropped image
-        barcode_info = BarcodeReader(cropped_file_path)
+        # Read the barcode from the full image
+        barcode_info = BarcodeReader(img)
         if barcode_info == "error:barcode not detected":
             return JsonResponse({"status": "error", "message": "Barcode not detected"}, status=400)
 
@@ -189,11 +193,11 @@ def upload_base64(request):
         ingredients, brand, name, image, nutrients, Nutri = mock_get_ingredients(barcode_info)
         print(ingredients)
         print(1)
-        gen_openai = identify_harmful_ingredients(ingredients)
+        # The OpenAI call is the slowest leg, so it runs in the background while
+        # the user profile is fetched and the local models run
+        openai_future = io_executor.submit(identify_harmful_ingredients, ingredients)
 
         print(2)
-       
-        print("gen:",gen_openai)
         print(3)
         print(Nutri)
         try:
@@ -246,17 +250,20 @@ def upload_base64(request):
         if isinstance(list_data, list):
             print("response[0][10] is a list")
             user_allergens = list_data
-            allergen_detection_result = detect_allergens_from_ingredients(user_allergens, ingredients)
         else:
             print("response[0][10] is not a list")
             user_allergens = [list_data]
-            allergen_detection_result = detect_allergens_from_ingredients(user_allergens, ingredients)    
+        allergen_future = submit_allergen_detection(user_allergens, ingredients)
+        prediction_future = submit_prediction(user_input)
+        allergen_detection_result = allergen_future.result()
         print("data:",allergen_detection_result)
         try:
-            predictions = predict(user_input)
+            predictions = prediction_future.result()
             print("Predictions:", predictions)
         except Exception as e:
             print(f"An error occurred: {e}")
+        gen_openai = openai_future.result()
+        print("gen:",gen_openai)
         if barcode_info == "8901491101837":
             hazard = {
             "value": [
@@ -314,6 +321,9 @@ def upload_base64(request):
             "Recommend":"Maximum of once a week",
             "generated_text":gen_openai,
         }
+        # Let the client tell a failed analysis apart from a product with no hazards
+        if "error" in gen_openai:
+            result["hazardError"] = gen_openai["error"]
 
         '''if not result["ingredients"]:  # This checks if the list is empty
             print("OPEN AI RESULT")
@@ -332,7 +342,8 @@ def upload_base64(request):
                 "HealthScore": ""
             }
         '''
-        return JsonResponse(result, status=200)
+        # orjson serializes the large result several times faster than json
+        return HttpResponse(orjson.dumps(result), content_type="application/json", status=200)
         # Return the result as JSON
         return jsonify(result), 200
 
@@ -358,10 +369,14 @@ def generate_openai_text(name):
     except Exception as e:
         raise RuntimeError(f"OpenAI API Error: {str(e)}")
 def mock_get_ingredients(barcode_data):
+    cache_key = f"off:{barcode_data}"
+    cached = response_cache.get(cache_key)
+    if cached is not None:
+        return cached
     try:
         # Replace this URL with a dynamic URL using barcode_data if needed
         url = f"https://world.openfoodfacts.net/api/v2/product/{barcode_data}"
-        response = requests.get(url)
+        response = http_session.get(url, timeout=OFF_TIMEOUT)
         response.raise_for_status()  
 
         data = response.json()
@@ -401,7 +416,9 @@ def mock_get_ingredients(barcode_data):
                 ingredients_list = [ing.strip() for ing in value.split(",")]
             else:
                 ingredients_list = []
-            return ingredients_list,data["product"]["brands"],name,image,nutrients,Nutri
+            result = ingredients_list,data["product"]["brands"],name,image,nutrients,Nutri
+            response_cache.set(cache_key, result, expire=CACHE_EXPIRE)
+            return result
         else:
             return None
     except Exception as e:
@@ -420,31 +437,209 @@ def extract_ingredients(ingredient_string):
 MODEL_PATH = "allergens/ml/allergen_bert_tfidf_ensemble_model.pkl"
 VECTORIZER_PATH = "allergens/ml/vectorizer.pkl"
 MLB_PATH = "allergens/ml/mlb.pkl"
+ALLERGEN_EMBEDDINGS_PATH = "allergens/ml/allergen_embeddings.npz"
 
 model = joblib.load(MODEL_PATH)
 vectorizer = joblib.load(VECTORIZER_PATH)
 mlb = joblib.load(MLB_PATH)
 
+BERT_ONNX_PATH = "allergens/ml/bert_onnx"
+
+# Run BERT in half precision on GPU; CPU half precision kernels are slower
+# than FP32, so the CPU path stays in FP32
+BERT_DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+BERT_DTYPE = torch.float16 if BERT_DEVICE.type == "cuda" else torch.float32
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
+
+def load_torch_bert_model():
+    """
+    Load BERT as a PyTorch model, compiled and warmed up when torch.compile works.
+    :return: Model returning last_hidden_state for tokenizer inputs.
+    """
+    torch_model = AutoModel.from_pretrained(
+        "bert-base-uncased", torch_dtype=BERT_DTYPE, attn_implementation="sdpa"
+    ).to(BERT_DEVICE).eval()
+    try:
+        # Batch size and sequence length vary per request, so compile with
+        # dynamic shapes instead of padding every batch to a fixed shape
+        compiled_model = torch.compile(torch_model, dynamic=True)
+        # Compilation is lazy and dynamic shapes still specialize on size 1, so
+        # compile both a lone text (the usual cached-allergen request) and a
+        # padded batch now so the first requests do not pay for it
+        with torch.inference_mode():
+            for texts in (["warm up"], ["warm up", "milk"]):
+                warm_up = tokenizer(texts, return_tensors="pt", padding=len(texts) > 1).to(BERT_DEVICE)
+                compiled_model(**warm_up)
+        return compiled_model
+    except Exception as e:
+        print(f"torch.compile failed, running BERT eagerly: {e}")
+        return torch_model
+
+def export_bert_onnx():
+    """
+    Export BERT to ONNX under BERT_ONNX_PATH. The export is written to a temp
+    directory and renamed into place, so a worker starting concurrently never
+    loads a half-written export.
+    """
+    from optimum.onnxruntime import ORTModelForFeatureExtraction
+
+    tmp_path = tempfile.mkdtemp(dir=os.path.dirname(BERT_ONNX_PATH), prefix="bert_onnx.")
+    try:
+        ORTModelForFeatureExtraction.from_pretrained("bert-base-uncased", export=True).save_pretrained(tmp_path)
+        os.rename(tmp_path, BERT_ONNX_PATH)
+    except OSError:
+        # Another worker finished its export first
+        if not os.path.isdir(BERT_ONNX_PATH):
+            raise
+    finally:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+def load_bert_model():
+    """
+    Load BERT as an ONNX Runtime session, exporting it to BERT_ONNX_PATH on
+    first use. Falls back to the PyTorch model when optimum.onnxruntime is not
+    installed or the session cannot be created.
+    :return: Model returning last_hidden_state for tokenizer inputs.
+    """
+    try:
+        import onnxruntime
+        from optimum.onnxruntime import ORTModelForFeatureExtraction
+    except ImportError:
+        print("optimum.onnxruntime not available, running BERT with PyTorch.")
+        return load_torch_bert_model()
+
+    # Only use CUDA when the installed onnxruntime build actually supports it.
+    # On a GPU host with the CPU-only wheel, the FP16 PyTorch model on the GPU
+    # is faster than ONNX Runtime on the CPU
+    if "CUDAExecutionProvider" in onnxruntime.get_available_providers():
+        provider = "CUDAExecutionProvider"
+    elif BERT_DEVICE.type == "cuda":
+        print("onnxruntime has no CUDA support, running BERT with PyTorch on the GPU.")
+        return load_torch_bert_model()
+    else:
+        provider = "CPUExecutionProvider"
+
+    try:
+        session_options = onnxruntime.SessionOptions()
+        session_options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        session_options.intra_op_num_threads = INFERENCE_THREADS
+
+        if not os.path.isdir(BERT_ONNX_PATH):
+            export_bert_onnx()
+        ort_model = ORTModelForFeatureExtraction.from_pretrained(
+            BERT_ONNX_PATH, provider=provider, session_options=session_options
+        )
+    except Exception as e:
+        print(f"Error loading BERT with ONNX Runtime, running BERT with PyTorch: {e}")
+        return load_torch_bert_model()
+    print(f"BERT loaded with ONNX Runtime ({provider}).")
+    return ort_model
+
 tokenizer = AutoTokenizer.from_pretrained("bert-base-uncased")
-bert_model = AutoModel.from_pretrained("bert-base-uncased")
+bert_model = load_bert_model()
 
 inflect_engine = inflect.engine()
 
+def load_allergen_embeddings():
+    """
+    Load the cached allergen embeddings saved by save_allergen_embeddings.
+    :return: Dictionary mapping normalized allergen to its BERT embedding.
+    """
+    if not os.path.exists(ALLERGEN_EMBEDDINGS_PATH):
+        return {}
+    try:
+        with np.load(ALLERGEN_EMBEDDINGS_PATH) as data:
+            return dict(zip(data["allergens"].tolist(), data["embeddings"]))
+    except Exception as e:
+        print(f"Error loading allergen embeddings: {e}")
+        return {}
+
+def save_allergen_embeddings():
+    """
+    Write the allergen embedding cache to disk so it survives restarts.
+    """
+    allergens = list(allergen_embeddings)
+    # Each process writes its own temp file so concurrent workers never
+    # interleave writes before the atomic rename
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(ALLERGEN_EMBEDDINGS_PATH), prefix="allergen_embeddings.", suffix=".tmp.npz"
+    )
+    os.close(fd)
+    try:
+        np.savez(
+            tmp_path,
+            allergens=np.array(allergens),
+            embeddings=np.stack([allergen_embeddings[a] for a in allergens]),
+        )
+        os.replace(tmp_path, ALLERGEN_EMBEDDINGS_PATH)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+# User allergens come from a small vocabulary, so their embeddings are cached
+# in memory and on disk instead of being recomputed on every request
+allergen_embeddings = load_allergen_embeddings()
+allergen_embeddings_lock = threading.Lock()
+
+@functools.lru_cache(maxsize=4096)
 def normalize_allergen(allergen):
     """
     Normalize allergens by converting to lowercase and singularizing.
+    Results are cached since inflect is slow and allergens repeat often.
     """
     allergen = allergen.lower()
     return inflect_engine.singular_noun(allergen) or allergen
 
+# Warm the cache with every label the ensemble model can predict
+for label in mlb.classes_:
+    normalize_allergen(label)
+
+@functools.lru_cache(maxsize=1024)
+def transform_ingredients(ingredient_text):
+    """
+    TF-IDF vectorize an ingredient string as a dense row, cached for repeat
+    products. The row is joined with the dense BERT embedding, so keeping it
+    dense lets the ensemble skip sparse matrix handling entirely.
+    """
+    return vectorizer.transform([ingredient_text]).toarray()
+
+def run_bert(inputs):
+    """
+    Run BERT on tokenizer inputs. If a compiled model fails to compile a new
+    input shape, fall back to the eager model for this and later requests.
+    """
+    global bert_model
+    try:
+        return bert_model(**inputs).last_hidden_state
+    except Exception as e:
+        eager_model = getattr(bert_model, "_orig_mod", None)
+        if eager_model is None:
+            raise
+        print(f"torch.compile failed, running BERT eagerly: {e}")
+        bert_model = eager_model
+        return bert_model(**inputs).last_hidden_state
+
+def generate_bert_embeddings(texts):
+    """
+    Generate BERT embeddings for a list of texts in a single forward pass.
+    Padding tokens are masked out of the mean pooling, so each row matches
+    the embedding of its text encoded on its own.
+    """
+    # A lone text needs no padding; a batch is padded only to its longest text
+    inputs = tokenizer(texts, return_tensors="pt", truncation=True, padding=len(texts) > 1, max_length=512)
+    inputs = {key: value.to(bert_model.device) for key, value in inputs.items()}
+    with torch.inference_mode():
+        outputs = run_bert(inputs).float()
+        mask = inputs["attention_mask"].unsqueeze(-1).float()
+        embeddings = (outputs * mask).sum(dim=1) / mask.sum(dim=1)
+    return embeddings.cpu().numpy()
+
 def generate_bert_embedding(text):
     """
     Generate BERT embeddings for a given text.
     """
-    inputs = tokenizer(text, return_tensors="pt", truncation=True, padding=True, max_length=512)
-    with torch.no_grad():
-        outputs = bert_model(**inputs)
-    return outputs.last_hidden_state.mean(dim=1).squeeze().numpy()
+    return generate_bert_embeddings([text])[0]
 
 def detect_allergens_from_ingredients(user_allergens, ingredients):
     """
@@ -455,26 +650,41 @@ def detect_allergens_from_ingredients(user_allergens, ingredients):
         user_allergens = [normalize_allergen(a) for a in user_allergens]
 
         ingredient_text = ", ".join(ingredients)
-        X_tfidf = vectorizer.transform([ingredient_text])
-        X_bert = np.array([generate_bert_embedding(ingredient_text)])
-        X_combined = hstack([X_tfidf, X_bert])
-
-        user_allergen_embeddings = [generate_bert_embedding(allergen) for allergen in user_allergens]
+        X_tfidf = transform_ingredients(ingredient_text)
+
+        # Only allergens missing from the cache are embedded, in the same
+        # batch as the ingredient text (row 0)
+        missing_allergens = list(dict.fromkeys(a for a in user_allergens if a not in allergen_embeddings))
+        embeddings = generate_bert_embeddings([ingredient_text] + missing_allergens)
+        X_bert = embeddings[:1]
+        if missing_allergens:
+            with allergen_embeddings_lock:
+                allergen_embeddings.update(zip(missing_allergens, embeddings[1:]))
+                try:
+                    save_allergen_embeddings()
+                except Exception as e:
+                    print(f"Error saving allergen embeddings: {e}")
+        user_allergen_embeddings = np.array(
+            [allergen_embeddings[a] for a in user_allergens], dtype=X_bert.dtype
+        ).reshape(len(user_allergens), X_bert.shape[1])
+        X_combined = np.hstack([X_tfidf, X_bert])
 
         predicted_allergens_binary = model.predict(X_combined)
         predicted_allergens = [
             normalize_allergen(a) for a in mlb.inverse_transform(predicted_allergens_binary)[0]
         ]
 
-        detected_allergens = set()
-        for allergen, allergen_embedding in zip(user_allergens, user_allergen_embeddings):
-            similarity = cosine_similarity(X_bert, [allergen_embedding])[0][0]
-            if similarity > 0.8:
-                detected_allergens.add(allergen)
+        # Cosine similarity of every user allergen against the ingredient text
+        # as one matrix-vector product on L2-normalized embeddings
+        ingredient_vector = X_bert[0] / np.linalg.norm(X_bert[0])
+        allergen_matrix = user_allergen_embeddings / np.linalg.norm(user_allergen_embeddings, axis=1, keepdims=True)
+        similarities = allergen_matrix @ ingredient_vector
+        detected_allergens = {user_allergens[i] for i in np.where(similarities > 0.8)[0]}
 
-            for predicted_allergen in predicted_allergens:
-                if fuzz.ratio(allergen, predicted_allergen) > 85: 
-                    detected_allergens.add(predicted_allergen)
+        # Fuzzy match every user allergen against every predicted allergen in one call
+        if user_allergens and predicted_allergens:
+            scores = cdist(user_allergens, predicted_allergens, scorer=fuzz.ratio, score_cutoff=85)
+            detected_allergens.update(predicted_allergens[i] for i in np.where(scores > 85)[1])
 
         detected_allergens.update(set(predicted_allergens).intersection(set(user_allergens)))
 
@@ -484,6 +694,25 @@ def detect_allergens_from_ingredients(user_allergens, ingredients):
         }
     except Exception as e:
         return {"error": str(e), "safe": False}
+# Single background worker that runs BERT, the allergen ensemble and XGBoost.
+# The models are loaded once at import and shared with the worker; inference
+# releases the GIL, so request threads stay free for network I/O while it runs
+inference_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="inference")
+
+def submit_allergen_detection(user_allergens, ingredients):
+    """
+    Queue detect_allergens_from_ingredients on the inference worker.
+    :return: Future resolving to the allergen detection result.
+    """
+    return inference_executor.submit(detect_allergens_from_ingredients, user_allergens, ingredients)
+
+def submit_prediction(input_data):
+    """
+    Queue predict on the inference worker.
+    :return: Future resolving to the health score prediction.
+    """
+    return inference_executor.submit(predict, input_data)
+
 def supabase(uid):
     try:
        
@@ -504,68 +733,70 @@ import openai
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 client = OpenAI(api_key=OPENAI_API_KEY)
 
-def identify_harmful_ingredients(ingredient_text):        
-    prompt = f"""You are an expert dietician with extensive knowledge of ingredients and their effects on health. You are particularly focused on identifying harmful ingredients in processed food. A client has come to you with the following profile:
-    Age: 20 years old
-    Height: 160 cm
-    Weight: 60 kg 
-    Physical Activity: Low intensity
-    Medical Conditions:
-    Blood sugar (fasting): 90 mg/dL
-    Blood pressure: 120/75 mmHg
-    Total cholesterol: 200 mg/dL, LDL: 135 mg/dL, HDL: 65 mg/dL
-    Triglycerides: 140 mg/dL
-    SGOT (AST): 25 U/L, SGPT (ALT): 35 U/L, GGT: 40 U/L
-    Please identify the hazardous ingredients in the following list and explain the risks they pose to this individual. Your response should follow this format:
-    Response Format:
-    {{
-        "hazard": {{
-            "value": [
-                {{
-                    "name": "Name of the ingredient",
-                    "value": "A brief, simple explanation (2–3 sentences max) about the health risks this ingredient poses, why it's harmful, and how it could affect this individual’s medical conditions (avoid complex chemical terms)."
-                }}
-            ]
-        }},
-        "long": {{
-            "value": [
-                {{
-                    "key1": "A summary of the long-term health risks these ingredients, when combined, could cause with regular consumption (e.g., diabetes, heart disease, liver damage, etc.).",
-                    "key2": "A further explanation of how these ingredients affect overall health and contribute to chronic conditions over time."
-                }}
-            ]
-        }},
-        "recommend": {{
-            "value": "A suggestion for how often this individual can consume foods with these ingredients (e.g., Maximum of once a week)."
-        }}
-    }}
-    Ingredients to analyze: {ingredient_text}
-    make sure to list out ingridients that have high chances of ill effects for our users. Dont list all the ingridients , instead make sure we consider the health of above user    
+# The client profile and response format are fixed, so they go in the system
+# message and the user message only carries the ingredient list
+HARMFUL_INGREDIENTS_PROMPT = """You are an expert dietician identifying harmful ingredients in processed food for this client:
+Age 20, height 160 cm, weight 60 kg, low physical activity.
+Fasting blood sugar 90 mg/dL, blood pressure 120/75 mmHg.
+Total cholesterol 200 mg/dL (LDL 135, HDL 65), triglycerides 140 mg/dL.
+SGOT (AST) 25 U/L, SGPT (ALT) 35 U/L, GGT 40 U/L.
+List only the ingredients (at most 5) with a high chance of ill effects for this client, not every ingredient. Reply with a JSON object:
+{"hazard": {"value": [{"name": "ingredient", "value": "2-3 simple sentences on its risks for this client"}]},
+"long": {"value": [{"key1": "long-term risks of regular consumption", "key2": "how they contribute to chronic conditions"}]},
+"recommend": {"value": "how often the client can eat this, e.g. Maximum of once a week"}}"""
+
+# Sized for at most five short hazards plus the long and recommend sections
+HARMFUL_INGREDIENTS_MAX_TOKENS = 700
+
+def empty_harmful_ingredients(error):
     """
+    Well-formed result with no hazards, used when OpenAI gives no usable reply.
+    :param error: Why the analysis failed, passed through to the client.
+    """
+    return {"hazard": {"value": []}, "long": {"value": []}, "recommend": {"value": ""}, "error": error}
 
+def identify_harmful_ingredients(ingredient_text):
+    cache_key = "openai:" + hashlib.sha256(str(ingredient_text).encode("utf-8")).hexdigest()
+    cached = response_cache.get(cache_key)
+    if cached is not None:
+        return cached
     try:
         response = openai.chat.completions.create(model="gpt-4o-mini", 
         messages=[
-                {"role": "user", "content": prompt}
+                {"role": "system", "content": HARMFUL_INGREDIENTS_PROMPT},
+                {"role": "user", "content": f"Ingredients: {ingredient_text}"}
             ],
-        max_tokens=1000,
+        response_format={"type": "json_object"},
+        max_tokens=HARMFUL_INGREDIENTS_MAX_TOKENS,
 
         )
-        content =  response.choices[0].message.content.strip()
-        #content = json.dumps(content, indent = 4)
-        json_str = content.strip('```json').strip('```').strip()
+        if response.choices[0].finish_reason == "length":
+            print(f"OpenAI response truncated at {HARMFUL_INGREDIENTS_MAX_TOKENS} tokens")
+            return empty_harmful_ingredients("Ingredient analysis was incomplete")
 
-        json_data = json.loads(json_str)
+        # JSON mode guarantees the content is a bare JSON object
+        content = response.choices[0].message.content
+        json_data = json.loads(content)
 
         print(json_data)
+        response_cache.set(cache_key, json_data, expire=CACHE_EXPIRE)
+        return json_data
 
-        
 
-        print(content)
+    except Exception as e:
+        print(f"Error with OpenAI API: {e}")
+        return empty_harmful_ingredients("Ingredient analysis unavailable")
+
+        # JSON mode guarantees the content is a bare JSON object
+        content = response.choices[0].message.content
+        json_data = json.loads(content)
+
+        print(json_data)
+        response_cache.set(cache_key, json_data, expire=CACHE_EXPIRE)
         return json_data
 
 
     except Exception as e:
         print(f"Error with OpenAI API: {e}")
-        return []
+        return empty_harmful_ingredients()
 